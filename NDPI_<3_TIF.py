@@ -7,25 +7,40 @@ filename.ndpis
 filename-DAPI.ndpi
 ...
 
-ROIs are extracted by finding the contours in a binary image and are then filtered by size (keep big hearts, skip the rest). 
-The binary image is created using blurring and otsu thresholding. 
+ROIs are extracted by finding the connected regions in a binary image and are then filtered by area (keep big hearts, skip the rest). 
+The binary image is created using blurring and thresholding (everything above background is kept). 
 The user is prompted to select the channel from which the ROIs should be extracted. 
 The same ROIs are then used to crop the images from the other channels. 
 
 Installation and usage instructions can be found at the bottom of this script.
 
-This is not the fastest script (single CPU core), but it does the job on its own.
-It works well for NDPI files of around 200-300MB, requiring about 20GB of RAM.
+ROIs of all channels are cropped and saved in parallel (MAX_WORKERS threads, one ROI per thread in memory).
+It works well for NDPI files of around 200-300MB. ROIs are read directly from the slide instead of loading the whole slide.
+Each thread holds the RGBA region of its ROI twice (openslide's buffer and the numpy copy made by np.asarray),
+plus a grayscale copy and the compressed stream (about 10 bytes per ROI pixel),
+so RAM usage is roughly MAX_WORKERS x 10 x the pixels of the largest ROI. Lower MAX_WORKERS if RAM is short.
+ROIs whose RGBA region exceeds MEMMAP_THRESHOLD are read in bands instead, which caps each thread at about 1.25 GB.
+
+ROIs are saved as tiled, zlib compressed TIF files. ROIs above MEMMAP_THRESHOLD are saved as uncompressed,
+strip based (not tiled) TIF files, because tifffile can only memory-map uncompressed contiguous data.
 It takes between 1-5 minutes per slide with 0.23-0.46um/pixel resolution. 
 The user is prompted to select either resolution level.
 
 """
 
 import openslide
+try:
+    # tiffslide (pure python, based on tifffile) is faster than openslide for NDPI files and has the same api
+    import tiffslide as openslide_backend
+except ImportError:
+    openslide_backend = openslide
 import os
-from PIL import ImageFilter
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
+import tifffile
 
 
 # ask for the path to the ndpis files
@@ -39,6 +54,26 @@ LEVEL = int(input("Enter the resolution level of the NDPI image (0 = highest res
 # Radius of Gaussian blur
 RADIUS = 25
 
+# ROIs are detected on a downsampled pyramid level of the cropping template that is at most
+# ROI_DOWNSAMPLE times smaller than LEVEL (RADIUS and THRESHOLD_SIZE are scaled to that level)
+ROI_DOWNSAMPLE = 16
+
+# number of threads that crop and save rois in parallel (openslide handles are thread-safe),
+# capped because every thread holds a whole roi in memory (see RAM note at the top)
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# tiffslide reads through one shared file handle per slide and does not document thread-safety,
+# so read_region calls on a tiffslide handle are serialized with a lock per slide (keyed by id of the handle)
+slide_locks = {}
+
+# tile size and zlib compression level of the saved tif files
+TILE_SIZE = (512, 512)
+COMPRESSION_LEVEL = 1
+
+# rois whose RGBA region (4 bytes per pixel) is larger than this many bytes are streamed band by band
+# into an uncompressed memory-mapped tif
+MEMMAP_THRESHOLD = 500 * 1024 ** 2
+
 # adjust THRESHOLD_SIZE to resolution level of ndpi image
 
 if LEVEL == 0:
@@ -54,69 +89,125 @@ if not os.path.exists(output_dir):
 
 
 
-ndpis_files = []
-for file in os.listdir(input_folder):
-    if file.endswith(".ndpis"):
-        ndpis_files.append(file)
+ndpis_files = [entry.name for entry in os.scandir(input_folder) if entry.name.endswith(".ndpis")]
 
 def get_ndpi_filenames(ndpis_file):
-    ndpi_files = []
     with open(ndpis_file, 'r') as f:
-        for line in f:
-            if line.endswith('.ndpi\n'):
-                # extract substring after "="
-                line = line.split("=")[1]
-                # save to list            
-                ndpi_files.append(line.rstrip('\n'))
-        # close file
-        f.close()
+        # extract substring after "=" of every line that ends with .ndpi
+        ndpi_files = re.findall(r'=([^=\n]*\.ndpi)$', f.read(), re.MULTILINE)
     return ndpi_files
 
 
-def ndpi_2_tif(ndpi_files):
-    ndpi_image = openslide.open_slide(ndpi_files)
-    # Convert the NDPI image to a grayscale TIF image
-    tiff_image = ndpi_image.read_region((0, 0), LEVEL, ndpi_image.level_dimensions[LEVEL]).convert('L')
-    ndpi_image.close()
+def to_gray(region, dst=None):
+    # openslide returns RGBA regions, tiffslide returns the samples stored in the file (RGB or grayscale)
+    region = np.asarray(region)
+    if region.ndim == 2:
+        return region
+    return cv2.cvtColor(region, cv2.COLOR_RGBA2GRAY if region.shape[2] == 4 else cv2.COLOR_RGB2GRAY, dst=dst)
+
+def matches_openslide(ndpi_file, slide):
+    # rois are computed from level_dimensions and level_downsamples, so check that tiffslide reports the same
+    # pyramid as openslide (read_region takes level 0 coordinates in both)
+    reference = openslide.open_slide(ndpi_file)
+    try:
+        return (tuple(map(tuple, slide.level_dimensions)) == tuple(map(tuple, reference.level_dimensions))
+                and np.allclose(slide.level_downsamples, reference.level_downsamples))
+    finally:
+        reference.close()
+
+def ndpi_2_tif(ndpi_image, level=LEVEL):
+    # Convert the NDPI image to a grayscale numpy array (one OpenCV pass over the region buffer, no PIL convert)
+    region = ndpi_image.read_region((0, 0), level, ndpi_image.level_dimensions[level])
+    tiff_image = to_gray(region)
     return tiff_image 
 
-def get_binary(tiff_image):
-    # blur the image to remove noise
-    blurred_image = tiff_image.filter(ImageFilter.GaussianBlur(RADIUS))
+def get_binary(tiff_image, radius=RADIUS):
+    # blur the image to remove noise: three box filters approximate a Gaussian with sigma = radius
+    # (box filters use running sums, so their cost does not depend on the radius)
+    box_size = int(np.sqrt(12 * radius ** 2 / 3 + 1)) | 1
+    blurred_image = cv2.boxFilter(tiff_image, -1, (box_size, box_size), borderType=cv2.BORDER_REPLICATE)
+    for _ in range(2):
+        cv2.boxFilter(blurred_image, -1, (box_size, box_size), dst=blurred_image, borderType=cv2.BORDER_REPLICATE)
 
-    # convert tiff_image to a binary image using otsu thresholding
-    binary_image = blurred_image.point(lambda p: p > 0 and 255)
-
-    # convert to numpy array
-    binary_image = np.array(binary_image)
+    # convert tiff_image to a binary image: every pixel that is not background after blurring becomes 255
+    # (cv2.threshold writes into the blurred buffer, so no temporary array is allocated)
+    _, binary_image = cv2.threshold(blurred_image, 0, 255, cv2.THRESH_BINARY, dst=blurred_image)
 
     return binary_image
 
-def get_rois(ndpi_file):
-
-    tiff_image = ndpi_2_tif(ndpi_file)
+def get_rois(ndpi_image):
 
-    binary_image = get_binary(tiff_image)
-    
-    # Find contours in binary image
-    contours, hierarchy = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Get bounding rectangles of contours
-    rois = []
-    for cnt in contours:
-        x, y, w, h = cv2.boundingRect(cnt)
-        rois.append((x, y, w, h))
-
-    # calculate size of each roi
-    sizes = []
-    for roi in rois:
-        sizes.append(roi[2] * roi[3])
-
-    # only keep rois that are larger than THRESHOLD_SIZE
-    rois = [roi for i, roi in enumerate(rois) if sizes[i] > THRESHOLD_SIZE]
+    # pick the pyramid level used for roi detection and its scale relative to LEVEL
+    roi_level = ndpi_image.get_best_level_for_downsample(ndpi_image.level_downsamples[LEVEL] * ROI_DOWNSAMPLE)
+    scale = ndpi_image.level_downsamples[roi_level] / ndpi_image.level_downsamples[LEVEL]
 
-    return rois
+    tiff_image = ndpi_2_tif(ndpi_image, roi_level)
 
+    binary_image = get_binary(tiff_image, RADIUS / scale)
+    
+    # Find connected regions in binary image, with their bounding rectangles and pixel areas
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary_image, connectivity=8)
+
+    # only keep rois whose area is larger than THRESHOLD_SIZE (scaled to the roi detection level), label 0 is the background
+    stats = stats[1:]
+    rects = stats[stats[:, cv2.CC_STAT_AREA] > THRESHOLD_SIZE / scale ** 2, :cv2.CC_STAT_AREA]
+
+    # rescale bounding rectangles to the coordinates of LEVEL
+    rois = [tuple(roi) for roi in np.rint(rects * scale).astype(int).tolist()]
+
+    # if there is no coarser level, the template is already decoded at LEVEL, return it so it is not decoded again
+    if roi_level != LEVEL:
+        tiff_image = None
+
+    return rois, tiff_image
+
+# grayscale buffer of each worker thread, reused for every roi it reads and grown to the largest one
+roi_buffers = threading.local()
+
+def get_roi_buffer(w, h):
+    buffer = getattr(roi_buffers, "buffer", None)
+    if buffer is None or buffer.size < w * h:
+        buffer = roi_buffers.buffer = np.empty(w * h, dtype=np.uint8)
+    return buffer[:w * h].reshape(h, w)
+
+def read_roi(slide, tiff_image, x, y, w, h):
+    # crop from the decoded image if there is one (slicing returns a view, pixels are only copied when the roi is written)
+    if tiff_image is not None:
+        return tiff_image[y:y + h, x:x + w]
+    # otherwise read the roi directly from the slide instead of loading the whole slide into memory
+    # (read_region expects the top left corner in level 0 coordinates)
+    ds = slide.level_downsamples[LEVEL]
+    lock = slide_locks.get(id(slide))
+    if lock is not None:
+        with lock:
+            region = slide.read_region((int(x * ds), int(y * ds)), LEVEL, (w, h))
+    else:
+        region = slide.read_region((int(x * ds), int(y * ds)), LEVEL, (w, h))
+    # the returned array is only valid until the same thread reads its next roi
+    return to_gray(region, get_roi_buffer(w, h))
+
+def save_roi(slide, roi, i, output_filename, tiff_image=None):
+    x, y, w, h = roi
+    # zero padded roi number, so that the files sort correctly
+    out_path = f"{output_filename}_roi_{i+1:03d}.tif"
+    # get roi number and dimensions of cropped image
+    cropped_image_dimensions = (w, h)
+    #print roi i of number_of_rois and dimensions of cropped_image and output_filename
+    print("ROI %d of %d with dimensions %s saved as %s" % (i+1, number_of_rois, cropped_image_dimensions, out_path))
+
+    if 4 * w * h > MEMMAP_THRESHOLD:
+        # write large rois through the page cache instead of holding the roi and its compressed stream in RAM
+        cropped_image = tifffile.memmap(out_path, shape=(h, w), dtype='uint8')
+        for y0 in range(0, h, TILE_SIZE[0]):
+            band_height = min(TILE_SIZE[0], h - y0)
+            cropped_image[y0:y0 + band_height] = read_roi(slide, tiff_image, x, y + y0, w, band_height)
+        cropped_image.flush()
+        del cropped_image
+    else:
+        cropped_image = read_roi(slide, tiff_image, x, y, w, h)
+        # save as tiled, lightly compressed tif (random access for downstream WSI tools)
+        tifffile.imwrite(out_path, cropped_image, tile=TILE_SIZE,
+                         compression='zlib', compressionargs={'level': COMPRESSION_LEVEL})
 
 
 
@@ -124,24 +215,40 @@ def get_rois(ndpi_file):
 for ndpis_file in ndpis_files:
 
     ndpi_files = get_ndpi_filenames(ndpis_file)
+    # open every channel once and reuse the handles for roi detection and cropping
+    slides = {ndpi_file: openslide_backend.open_slide(ndpi_file) for ndpi_file in ndpi_files if ndpi_file.endswith(".ndpi")}
     CROPPING_TEMPLATE_CHANNEL = [ndpi_file for ndpi_file in ndpi_files if CROPPING_TEMPLATE_CHANNEL_NAME in ndpi_file][0]
-    rois = get_rois(CROPPING_TEMPLATE_CHANNEL)
+    slide_locks = {}
+    if openslide_backend is not openslide:
+        # all channels of a scan share the same pyramid, so comparing the cropping template is enough
+        if matches_openslide(CROPPING_TEMPLATE_CHANNEL, slides[CROPPING_TEMPLATE_CHANNEL]):
+            slide_locks = {id(slide): threading.Lock() for slide in slides.values()}
+        else:
+            print("tiffslide and openslide report different pyramid levels for %s, reading it with openslide" % ndpis_file)
+            for slide in slides.values():
+                slide.close()
+            slides = {ndpi_file: openslide.open_slide(ndpi_file) for ndpi_file in slides}
+    rois, template_image = get_rois(slides[CROPPING_TEMPLATE_CHANNEL])
     number_of_rois = len(rois)
+    # channels that are already decoded at LEVEL are cropped from memory instead of being read again
+    tiff_images = {CROPPING_TEMPLATE_CHANNEL: template_image}
+
+    output_filenames = {ndpi_file: os.path.join(output_dir, os.path.splitext(os.path.basename(ndpi_file))[0]) for ndpi_file in slides}
 
-    for ndpi_file in ndpi_files:
-        if ndpi_file.endswith(".ndpi"):
+    # crop and save the rois of all channels in parallel
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        jobs = []
+        # submit roi by roi, so that the threads read different channels (and take different slide locks) at the same time
+        for i, roi in enumerate(rois):
+            for ndpi_file, slide in slides.items():
+                jobs.append(executor.submit(save_roi, slide, roi, i, output_filenames[ndpi_file], tiff_images.get(ndpi_file)))
 
-            output_filename = os.path.join(output_dir, os.path.splitext(os.path.basename(ndpi_file))[0])
-            tiff_image = ndpi_2_tif(ndpi_file)
-         
-            for i, roi in enumerate(rois):
-                x, y, w, h = roi
-                cropped_image = tiff_image.crop((x, y, x + w, y + h))
-                # get roi number and dimensions of cropped image
-                cropped_image_dimensions = cropped_image.size
-                #print roi i of number_of_rois and dimensions of cropped_image and output_filename
-                print("ROI %d of %d with dimensions %s saved as %s" % (i+1, number_of_rois, cropped_image_dimensions, output_filename + "_roi_0" + str(i+1) + ".tif"))
-                cropped_image.save(output_filename + "_roi_0" + str(i+1) + ".tif")
+        # re-raise errors from the worker threads
+        for job in jobs:
+            job.result()
+
+    for slide in slides.values():
+        slide.close()
 
 
 
@@ -170,7 +277,10 @@ https://github.com/conda-forge/miniforge
 
 mamba create -n openslide-env openslide-python
 mamba activate openslide-env
-pip install opencv-python
+pip install opencv-python tifffile
+
+optional, faster NDPI decoding (used instead of openslide if installed):
+pip install tiffslide
 
 
 3) Usage